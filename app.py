@@ -1,15 +1,92 @@
 import pandas as pd
 import streamlit as st
 import numpy as np
+import pyarrow as pa
+from pyarrow import csv as pacsv
+import pyarrow.parquet as pq
 import os
+import hashlib
+import re
+import tempfile
 from io import BytesIO
 
-@st.cache_data
-def load_file(file):
-    if file.name.endswith('.xlsx'):
-        return pd.read_excel(file)
+def read_excel(source, **kwargs):
+    # calamine (Rust) parses xlsx several times faster than openpyxl; fall back if it isn't installed
+    # (ImportError) or pandas predates the engine (ValueError "Unknown engine" before 2.2)
+    try:
+        return pd.read_excel(source, engine='calamine', **kwargs)
+    except (ImportError, ValueError):
+        if hasattr(source, 'seek'):
+            source.seek(0)
+        return pd.read_excel(source, engine='openpyxl', **kwargs)
+
+def load_file(file_bytes, file_name):
+    if file_name.endswith('.xlsx'):
+        return read_excel(BytesIO(file_bytes))
+    # Columnar uploads skip text parsing entirely
+    if file_name.endswith('.parquet'):
+        return pd.read_parquet(BytesIO(file_bytes), engine='pyarrow')
+    if file_name.endswith('.feather'):
+        return pd.read_feather(BytesIO(file_bytes))
+    try:
+        # Multithreaded Arrow parser through pandas, which applies pandas' NA handling (blank cells,
+        # 'NA', 'N/A', ...) so org columns get the same NaN -> 'Unknown' fill as Excel uploads
+        return pd.read_csv(BytesIO(file_bytes), engine='pyarrow')
+    except pd.errors.ParserError:
+        return pd.read_csv(BytesIO(file_bytes))
+
+# Layout of the Parquet threshold copy (columns and dtypes). Bump whenever load_threshold changes
+# what it stores, so copies written by older code are re-parsed instead of served.
+threshold_copy_version = 1
+
+# cache_resource hands every rerun the same read-only frame instead of unpickling a copy
+@st.cache_resource(ttl="1h", max_entries=8)
+def load_threshold(path, mtime_ns, size):
+    # mtime_ns and size are only part of the cache key, so editing the file invalidates the cached copy
+    parquet_path = os.path.splitext(path)[0] + '.parquet'
+    # The copy is stamped with the source's exact mtime and size and the layout version. Any mismatch
+    # re-parses the source, including deploys (unzip, rsync -t, cp -p) that give it an older mtime.
+    stamp = {
+        b'source_mtime_ns': str(mtime_ns).encode(),
+        b'source_size': str(size).encode(),
+        b'copy_version': str(threshold_copy_version).encode()
+    }
+    if os.path.exists(parquet_path):
+        try:
+            copy_metadata = pq.read_schema(parquet_path).metadata or {}
+        except Exception:
+            copy_metadata = {}
+        if all(copy_metadata.get(key) == value for key, value in stamp.items()):
+            return pd.read_parquet(parquet_path, engine='pyarrow')
+    # Only the columns used for alerting are parsed, keeping the cached frame and Parquet copy small
+    used_columns = ['Facility_ID', 'Disease', 'Season', 'Mean', 'SD', 'Threshold_95', 'Threshold_99']
+    if path.endswith('.xlsx'):
+        df = read_excel(path, usecols=lambda col: col in used_columns)
     else:
-        return pd.read_csv(file)
+        # Multithreaded Arrow parser, limited to the used columns present in the header
+        with pacsv.open_csv(path) as reader:
+            header = reader.schema.names
+        convert_options = pacsv.ConvertOptions(include_columns=[col for col in header if col in used_columns])
+        df = pacsv.read_csv(path, convert_options=convert_options).to_pandas()
+    # Categorical key columns: season filtering and the (Facility_ID, Disease) index work on integer codes
+    df = df.astype({col: 'category' for col in ['Facility_ID', 'Disease', 'Season'] if col in df.columns})
+    # float32 statistics halve the bytes moved by the threshold comparisons
+    df = df.astype({col: 'float32' for col in ['Mean', 'SD', 'Threshold_95', 'Threshold_99'] if col in df.columns})
+    # One-time migration: later loads read the typed Parquet copy instead of re-parsing text.
+    # Written to a temporary file and renamed, so concurrent sessions never read a partial file.
+    tmp_path = None
+    try:
+        fd, tmp_path = tempfile.mkstemp(suffix='.tmp.parquet', dir=os.path.dirname(parquet_path) or '.')
+        os.close(fd)
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        table = table.replace_schema_metadata({**(table.schema.metadata or {}), **stamp})
+        pq.write_table(table, tmp_path, compression='zstd')
+        os.replace(tmp_path, parquet_path)
+    except Exception:
+        # Read-only folder or unconvertible column; keep serving from the source file
+        if tmp_path is not None and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return df
 
 def load_threshold_local(province):
     # Mapping of province names to threshold file names
@@ -26,10 +103,8 @@ def load_threshold_local(province):
         st.stop()
     try:
         if os.path.exists(threshold_filename):
-            if threshold_filename.endswith('.xlsx'):
-                df = pd.read_excel(threshold_filename)
-            else:
-                df = pd.read_csv(threshold_filename)
+            source_stat = os.stat(threshold_filename)
+            df = load_threshold(threshold_filename, source_stat.st_mtime_ns, source_stat.st_size)
             if df.empty:
                 raise ValueError("Local file is empty.")
             return df
@@ -39,6 +114,239 @@ def load_threshold_local(province):
         st.error(f"Failed to load local threshold file '{threshold_filename}': {e}. Please ensure the file exists in the same folder as app.py.")
         st.stop()
 
+# Diseases matched against 'Year-Round' thresholds; all others use the current season
+year_round_diseases = [
+    'Acute Flaccid Paralysis (New Cases)', 'Botulism (New Cases)', 'Gonorrhea (New Cases)', 
+    'HIV/AIDS (New Cases)', 'Leprosy (New Cases)', 'Nosocomial Infections (New Cases)', 
+    'Syphilis (New Cases)', 'Visceral Leishmaniasis (New Cases)', 'Neonatal Tetanus (New Cases)'
+]
+
+@st.cache_data(max_entries=16)
+def season_threshold_tables(threshold_df, season):
+    # Facility_ID x Disease table per statistic, built once per province and season and reused across uploads
+    year_round_rows = threshold_df['Disease'].isin(year_round_diseases)
+    filtered_thresholds = threshold_df[
+        ((threshold_df['Season'] == season) & ~year_round_rows) |
+        ((threshold_df['Season'] == 'Year-Round') & year_round_rows)
+    ]
+    keyed_thresholds = filtered_thresholds.set_index(['Facility_ID', 'Disease'])
+    return {col: keyed_thresholds[col].unstack() for col in ['Threshold_95', 'Threshold_99', 'Mean', 'SD']}
+
+def crossed_cells(cases, t95, t99):
+    # Elementwise mask over aligned case/threshold arrays of any shape (e.g. several weeks stacked).
+    # NaN thresholds compare False, so cells without thresholds never alert.
+    crossed = cases > t95
+    crossed |= cases > t99
+    crossed &= ~np.isnan(t95)
+    return crossed
+
+def score_cells(cases, t95, t99):
+    # Level and deviation for cells already known to cross, so only alerting cells are scored
+    high = cases > t99
+    level_codes = high.view(np.int8) + np.int8(1)  # 1 = Alert, 2 = High Alert
+    # Deviation from whichever threshold was crossed
+    deviation = cases - np.where(high, t99, t95)
+    return level_codes, deviation
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def preprocess_upload(cache_version, upload_key, _file_bytes, file_name):
+    # Parsing doesn't depend on the province, so switching provinces reuses the parsed upload.
+    # Takes compute_alerts' cache_version, so one bump invalidates both the parse and the alerts built on it
+    new_df = load_file(_file_bytes, file_name)
+    st.write("New week data loaded. Shape:", new_df.shape)
+
+    # Remove unnecessary columns
+    columns_to_remove = ['periodid', 'periodcode', 'perioddescription', 'organisationunitid', 'organisationunitcode', 'organisationunitdescription']
+    new_df = new_df.drop(columns=[col for col in columns_to_remove if col in new_df.columns])
+
+    # Org levels and Facility_ID
+    org_cols = ['orgunitlevel1', 'orgunitlevel2', 'orgunitlevel3', 'orgunitlevel4', 'orgunitlevel5', 'organisationunitname']
+    present_org_cols = [col for col in org_cols if col in new_df.columns]
+    new_df[present_org_cols] = new_df[present_org_cols].fillna('Unknown').astype(str)
+    if all(col in new_df.columns for col in org_cols):
+        # Single join pass instead of chained Series '+' (each allocating a new string column)
+        facility_ids = ['_'.join(parts) for parts in zip(*(new_df[col].to_numpy() for col in org_cols))]
+        new_df['Facility_ID'] = pd.Categorical(facility_ids)
+        st.write(f"Unique Facility_IDs: {new_df['Facility_ID'].nunique()}")
+    else:
+        raise ValueError("Missing required org columns.")
+
+    # Parse periodname (prioritize KP-like "Week X YYYY..." pattern)
+    if 'periodname' in new_df.columns:
+        # Both formats in a single scan; the KP/Sindh groups still win if any row matches them
+        period_pattern = re.compile(
+            r'Week (?P<Week_kp>\d{1,2}) (?P<Year_kp>\d{4})-\d{2}-\d{2} - \d{4}-\d{2}-\d{2}'  # KP/Sindh format first
+            r'|(?P<Year_w>\d{4})W(?P<Week_w>\d{1,2})'  # W1 fallback
+        )
+        # periodname repeats across facilities: strip and run the regex once per distinct value and map back by code
+        period_codes, periods = pd.factorize(new_df['periodname'], use_na_sentinel=False)
+        extracted = pd.Series(periods).astype(str).str.strip().str.extract(period_pattern)
+        extracted = extracted.iloc[period_codes].set_axis(new_df.index)
+        best_extracted = None
+        for fmt in ['kp', 'w']:
+            candidate = extracted[[f'Year_{fmt}', f'Week_{fmt}']].set_axis(['Year', 'Week'], axis=1)
+            success = candidate.notna().all(axis=1).sum()
+            if success > 0:
+                best_extracted = candidate
+                st.write(f"Matched pattern with {success} rows.")
+                break
+        if best_extracted is not None:
+            # Drop old Year/Week if exist to avoid conflict
+            new_df = new_df.drop(columns=[col for col in ['Year', 'Week'] if col in new_df.columns])
+            # Assigned as new columns rather than concatenated, which would copy every disease column.
+            # The regex groups are digit-only, so a direct nullable-int cast replaces to_numeric's coercion
+            new_df['Year'] = best_extracted['Year'].astype('Int16')
+            new_df['Week'] = best_extracted['Week'].astype('Int8')
+            new_df = new_df.dropna(subset=['Year', 'Week'])
+            if new_df.empty:
+                raise ValueError("No valid weeks parsed after dropna.")
+            new_week = new_df['Week'].iloc[0]
+            st.write(f"Parsed Week: {new_week}")
+        else:
+            raise ValueError("No pattern matched periodname. Check format (e.g., 'Week 40 2025-...').")
+    else:
+        raise ValueError("No 'periodname' column.")
+
+    # Season (vectorized over Week; rows without a parsed week were dropped above)
+    # Season boundaries: Spring 10-20, Summer 21-35, Autumn 36-43, Winter otherwise
+    season_starts = np.array([10, 21, 36, 44])
+    season_codes = np.array([3, 0, 1, 2, 3], dtype=np.int8)  # bucket -> index into the categories below
+    bucket = np.searchsorted(season_starts, new_df['Week'].to_numpy(), side='right')
+    new_df['Season'] = pd.Categorical.from_codes(season_codes[bucket], categories=['Spring', 'Summer', 'Autumn', 'Winter'])
+    st.write(f"Season: {new_df['Season'].iloc[0]}")
+
+    # Disease columns
+    disease_cols = [col for col in new_df.columns if '(New Cases)' in col or '(New cases)' in col]
+    if len(disease_cols) == 0:
+        raise ValueError("No disease columns found.")
+    # 'Other' catch-all diseases never raise alerts, so they are excluded before any threshold work
+    disease_cols = [col for col in disease_cols if 'Other' not in col]
+    # Counts are filled and cast as one (facility x disease) matrix instead of per-column frame
+    # operations, and kept out of the frame since the alert code only works on the matrix
+    counts = new_df[disease_cols].to_numpy(dtype=np.float64)
+    counts = np.where(np.isnan(counts), 0, counts)
+    # Weekly counts fit int16 in practice; fall back to int32 rather than wrap around on huge values
+    count_dtype = np.int16 if counts.max(initial=0) <= np.iinfo(np.int16).max else np.int32
+    counts = counts.astype(count_dtype)
+    if new_df.empty:
+        raise ValueError("DataFrame is empty after parsing—cannot compute alerts.")
+    return new_df[['Facility_ID', 'Season']], new_week, disease_cols, counts
+
+# compute_alerts is persisted to disk, and Streamlit keys a cached function on its own source only,
+# not on the helpers and globals it uses (load_file, preprocess_upload, year_round_diseases,
+# season_threshold_tables, crossed_cells, score_cells). Bump this whenever any of them changes,
+# otherwise results computed by the old code keep being served after a redeploy.
+alerts_cache_version = 1
+
+# Persisted to disk so the weekly upload's results survive restarts and are shared across sessions
+# (Streamlit ignores ttl for disk-persisted caches, so max_entries bounds it instead)
+@st.cache_data(persist="disk", max_entries=32)
+def compute_alerts(cache_version, upload_key, _file_bytes, file_name, threshold_df):
+    # Keyed on the upload's SHA-256 digest: the leading underscore keeps Streamlit from hashing the
+    # raw bytes again, so re-running on the same file skips parsing and threshold matching
+    new_df, new_week, disease_cols, counts = preprocess_upload(cache_version, upload_key, _file_bytes, file_name)
+
+    current_season = new_df['Season'].iloc[0]
+    if 'Season' not in threshold_df.columns:
+        raise ValueError("Threshold file does not have 'Season' column. Please check the file structure.")
+
+    season_tables = season_threshold_tables(threshold_df, current_season)
+    known_facilities = season_tables['Threshold_95'].index
+    known_diseases = season_tables['Threshold_95'].columns
+
+    # Zero-case cells can never exceed a (non-negative) threshold, and facilities or diseases
+    # without thresholds can never alert, so both are dropped before the threshold lookup
+    has_cases = counts > 0
+    has_cases &= np.isin(disease_cols, known_diseases)
+    active_cols = has_cases.any(axis=0)
+    active_rows = has_cases.any(axis=1) & new_df['Facility_ID'].isin(known_facilities).to_numpy()
+    disease_cols = [col for col, active in zip(disease_cols, active_cols) if active]
+    new_df = new_df[active_rows]
+    cases = counts[np.ix_(active_rows, active_cols)]
+
+    is_year_round = np.isin(disease_cols, year_round_diseases)
+    disease_seasons = np.where(is_year_round, 'Year-Round', current_season)
+
+    # Compare on the wide (facility x disease) matrix instead of melting to one row per cell
+    facility_ids = new_df['Facility_ID'].to_numpy()
+
+    def threshold_matrix(col):
+        return season_tables[col].reindex(index=facility_ids, columns=disease_cols).to_numpy(dtype=np.float32)
+
+    t95, t99, mean, sd = (threshold_matrix(col) for col in ['Threshold_95', 'Threshold_99', 'Mean', 'SD'])
+    # Rows from another season (multi-week uploads) only match year-round thresholds
+    in_season = (new_df['Season'] == current_season).to_numpy()
+    matched = in_season[:, None] | is_year_round
+
+    keep = crossed_cells(cases, t95, t99)
+    keep &= matched
+
+    # Disease-major order, matching the row order the melted frame used to have
+    cols, rows = np.nonzero(keep.T)
+    alert_cases, alert_t95, alert_t99 = cases[rows, cols], t95[rows, cols], t99[rows, cols]
+    level_codes, deviation = score_cells(alert_cases, alert_t95, alert_t99)
+    alerts = pd.DataFrame({
+        'Facility_ID': facility_ids[rows],
+        'Disease': np.asarray(disease_cols, dtype=object)[cols],
+        'Season': disease_seasons[cols],
+        'Cases': alert_cases,
+        'Mean': mean[rows, cols],
+        'SD': sd[rows, cols],
+        'Threshold_95': alert_t95,
+        'Threshold_99': alert_t99,
+        'Alert_Level': pd.Categorical.from_codes(level_codes, ['Normal', 'Alert', 'High Alert']),
+        'Deviation': deviation
+    })
+    return alerts, new_week
+
+@st.fragment
+def render_alerts(priority_alerts, non_priority_alerts, max_dev, province, new_week, offer_excel):
+    # Slider changes rerun only this fragment with the same arguments, so the alerts, the
+    # priority split and the slider bounds are not recomputed
+    # Conditionally render sliders only if non-priority alerts exist
+    if len(non_priority_alerts) > 0:
+        col1, col2 = st.columns(2)
+        with col1:
+            top_n = st.slider("Top N Non-Priority Alerts", min_value=0, max_value=len(non_priority_alerts), value=min(50, len(non_priority_alerts)))
+        with col2:
+            min_dev = st.slider("Min Deviation for Non-Priority", min_value=0.0, max_value=max_dev, value=0.0)
+    else:
+        top_n = 0
+        min_dev = 0.0
+
+    # Partial selection of the N largest deviations; only the small final frame is fully sorted
+    filtered_non_priority = non_priority_alerts[(non_priority_alerts['Deviation'] >= min_dev)].nlargest(top_n, 'Deviation')
+    final_alerts = pd.concat([priority_alerts, filtered_non_priority], ignore_index=True)
+    final_alerts = final_alerts.sort_values('Deviation', ascending=False)
+
+    st.write(f"Total alerts for {province}: {len(final_alerts)} ({len(priority_alerts)} priority + {len(filtered_non_priority)} filtered)")
+
+    if not final_alerts.empty:
+        st.dataframe(final_alerts)
+
+        province_key = province.lower().replace(" ", "_")
+        csv_data = final_alerts.to_csv(index=False).encode('utf-8')
+        if offer_excel:
+            output = BytesIO()
+            # No constant_memory: it requires row-by-row writes, but to_excel fills cells column by column
+            with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
+                final_alerts.to_excel(writer, index=False, sheet_name='Alerts')
+            st.download_button(
+                label=f"Download Alerts for {province} Week {new_week} (Excel)",
+                data=output.getvalue(),
+                file_name=f'alerts_{province_key}_week_{new_week}.xlsx',
+                mime='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+            )
+        # CSV is always offered; it serializes far faster than xlsx for large alert weeks
+        st.download_button(
+            label=f"Download Alerts for {province} Week {new_week} (CSV)",
+            data=csv_data,
+            file_name=f'alerts_{province_key}_week_{new_week}.csv',
+            mime='text/csv'
+        )
+    else:
+        st.warning("No alerts generated.")
+
 # Streamlit app title
 st.title("IDSRS Pakistan, Disease Outbreak Detection App for Provinces")
 
@@ -63,7 +371,7 @@ st.success(f"Threshold file loaded for {selected_province} from local.")
 progress_bar.progress(30)
 
 # Upload new week file (weekly data)
-new_file = st.file_uploader("Upload new week data (CSV or Excel)", type=['xlsx', 'csv'])
+new_file = st.file_uploader("Upload new week data (CSV, Excel, Parquet or Feather)", type=['xlsx', 'csv', 'parquet', 'feather'])
 
 # Priority diseases
 priority_diseases = [
@@ -80,196 +388,53 @@ selected_priority_diseases = st.multiselect(
     default=priority_diseases
 )
 
+# CSV is always offered; the xlsx workbook is built in memory, so it is only written when asked for
+offer_excel = st.checkbox("Also offer Excel download")
+
 # Run button
 if st.button("Generate Alerts"):
     if threshold_df is not None and new_file is not None:
-        status.text('Loading new week data...')
+        status.text('Computing alerts...')
         progress_bar.progress(40)
-        new_df = load_file(new_file)
-        st.write("New week data loaded. Shape:", new_df.shape)
-
-        # Remove unnecessary columns
-        columns_to_remove = ['periodid', 'periodcode', 'perioddescription', 'organisationunitid', 'organisationunitcode', 'organisationunitdescription']
-        new_df = new_df.drop(columns=[col for col in columns_to_remove if col in new_df.columns])
-
-        # Org levels and Facility_ID
-        org_cols = ['orgunitlevel1', 'orgunitlevel2', 'orgunitlevel3', 'orgunitlevel4', 'orgunitlevel5', 'organisationunitname']
-        for col in org_cols:
-            if col in new_df.columns:
-                new_df[col] = new_df[col].fillna('Unknown').astype(str)
-        if all(col in new_df.columns for col in org_cols):
-            new_df['Facility_ID'] = (new_df['orgunitlevel1'] + '_' + new_df['orgunitlevel2'] + '_' + 
-                                     new_df['orgunitlevel3'] + '_' + new_df['orgunitlevel4'] + '_' + 
-                                     new_df['orgunitlevel5'] + '_' + new_df['organisationunitname'])
-            st.write(f"Unique Facility_IDs: {new_df['Facility_ID'].nunique()}")
-        else:
-            st.error("Missing required org columns.")
+        try:
+            file_bytes = new_file.getvalue()
+            upload_key = hashlib.sha256(file_bytes).hexdigest()
+            alerts, new_week = compute_alerts(alerts_cache_version, upload_key, file_bytes, new_file.name, threshold_df)
+        except ValueError as e:
+            st.error(str(e))
             st.stop()
 
-        status.text('Parsing week and season...')
-        progress_bar.progress(50)
-        # Parse periodname (prioritize KP-like "Week X YYYY..." pattern)
-        if 'periodname' in new_df.columns:
-            new_df['periodname'] = new_df['periodname'].astype(str).str.strip()
-            patterns = [
-                r'Week (\d+) (\d{4})-\d{2}-\d{2} - \d{4}-\d{2}-\d{2}',  # KP/Sindh format first
-                r'(\d{4})W(\d{1,2})',  # W1 fallback
-            ]
-            best_extracted = None
-            for pat in patterns:
-                extracted = new_df['periodname'].str.extract(pat)
-                if extracted.shape[1] == 2:
-                    if 'Week' in pat:
-                        extracted.columns = ['Week', 'Year']
-                    else:
-                        extracted.columns = ['Year', 'Week']
-                    success = extracted.notna().all(axis=1).sum()
-                    if success > 0:
-                        best_extracted = extracted
-                        st.write(f"Matched pattern with {success} rows.")
-                        break
-            if best_extracted is not None:
-                # Drop old Year/Week if exist to avoid conflict
-                if 'Year' in new_df.columns:
-                    new_df = new_df.drop(columns=['Year'])
-                if 'Week' in new_df.columns:
-                    new_df = new_df.drop(columns=['Week'])
-                new_df = pd.concat([new_df, best_extracted], axis=1)
-                new_df['Year'] = pd.to_numeric(new_df['Year'], errors='coerce')
-                new_df['Week'] = pd.to_numeric(new_df['Week'], errors='coerce')
-                new_df = new_df.dropna(subset=['Year', 'Week'])
-                if new_df.empty:
-                    st.error("No valid weeks parsed after dropna.")
-                    st.stop()
-                new_week = new_df['Week'].iloc[0]
-                st.write(f"Parsed Week: {new_week}")
-            else:
-                st.error("No pattern matched periodname. Check format (e.g., 'Week 40 2025-...').")
-                st.stop()
-        else:
-            st.error("No 'periodname' column.")
-            st.stop()
-
-        # Season
-        def assign_season(week):
-            if pd.isna(week):
-                return 'Unknown'
-            week = int(week)
-            if 10 <= week <= 20:
-                return 'Spring'
-            elif 21 <= week <= 35:
-                return 'Summer'
-            elif 36 <= week <= 43:
-                return 'Autumn'
-            else:
-                return 'Winter'
-
-        new_df['Season'] = new_df['Week'].apply(assign_season)
-        st.write(f"Season: {new_df['Season'].iloc[0]}")
-
-        status.text('Melting and merging data...')
-        progress_bar.progress(70)
-        # Disease columns and melt
-        disease_cols = [col for col in new_df.columns if '(New Cases)' in col or '(New cases)' in col]
-        if len(disease_cols) == 0:
-            st.error("No disease columns found.")
-            st.stop()
-        new_df[disease_cols] = new_df[disease_cols].fillna(0).astype(int)
-        # Check if DF is non-empty before melt
-        if new_df.empty:
-            st.error("DataFrame is empty after parsing—cannot melt.")
-            st.stop()
-        long_new = pd.melt(new_df, id_vars=['Facility_ID', 'Season'], value_vars=disease_cols, var_name='Disease', value_name='Cases')
-        long_new['Cases'] = long_new['Cases'].astype(int)
-        st.write("Melted data shape:", long_new.shape)
-
-        # Year-round override
-        year_round_diseases = [
-            'Acute Flaccid Paralysis (New Cases)', 'Botulism (New Cases)', 'Gonorrhea (New Cases)', 
-            'HIV/AIDS (New Cases)', 'Leprosy (New Cases)', 'Nosocomial Infections (New Cases)', 
-            'Syphilis (New Cases)', 'Visceral Leishmaniasis (New Cases)', 'Neonatal Tetanus (New Cases)'
-        ]
-        long_new.loc[long_new['Disease'].isin(year_round_diseases), 'Season'] = 'Year-Round'
-
-        # Filter thresholds for speed
-        current_season = new_df['Season'].iloc[0]
-        if 'Season' not in threshold_df.columns:
-            st.error("Threshold file does not have 'Season' column. Please check the file structure.")
-            st.stop()
-        filtered_thresholds = threshold_df[threshold_df['Season'].isin([current_season, 'Year-Round'])]
-        alerts = long_new.merge(filtered_thresholds[['Facility_ID', 'Disease', 'Season', 'Threshold_95', 'Threshold_99', 'Mean', 'SD']], how='left')
-
-        alerts['Alert_Level'] = np.where(
-            (alerts['Cases'] > alerts['Threshold_99']) & alerts['Threshold_99'].notna(), 'High Alert',
-            np.where(
-                (alerts['Cases'] > alerts['Threshold_95']) & alerts['Threshold_95'].notna(), 'Alert', 'Normal'
-            )
-        )
-        alerts['Deviation'] = np.where(
-            alerts['Alert_Level'] == 'High Alert', alerts['Cases'] - alerts['Threshold_99'],
-            np.where(alerts['Alert_Level'] == 'Alert', alerts['Cases'] - alerts['Threshold_95'], 0)
-        )
-
-        # Filter alerts
-        alerts = alerts[(alerts['Alert_Level'] != 'Normal') & 
-                        alerts['Threshold_95'].notna() & 
-                        (~alerts['Disease'].str.contains('Other', na=False))].copy()
-        alerts = alerts[['Facility_ID', 'Disease', 'Season', 'Cases', 'Mean', 'SD', 'Threshold_95', 'Threshold_99', 'Alert_Level', 'Deviation']]
-
-        status.text('Filtering alerts...')
-        progress_bar.progress(90)
-        # Priority filtering
-        priority_alerts = alerts[alerts['Disease'].isin(selected_priority_diseases)]
-        non_priority_alerts = alerts[~alerts['Disease'].isin(selected_priority_diseases)]
-        st.write(f"Priority alerts count: {len(priority_alerts)}, Non-priority alerts count: {len(non_priority_alerts)}")  # Debug line - remove if not needed
-        
-        # Conditionally render sliders only if non-priority alerts exist
-        if len(non_priority_alerts) > 0:
-            col1, col2 = st.columns(2)
-            with col1:
-                top_n = st.slider("Top N Non-Priority Alerts", min_value=0, max_value=len(non_priority_alerts), value=min(50, len(non_priority_alerts)))
-            with col2:
-                max_dev = non_priority_alerts['Deviation'].max()
-                min_dev = st.slider("Min Deviation for Non-Priority", min_value=0.0, max_value=max_dev, value=0.0)
-        else:
-            top_n = 0
-            min_dev = 0.0
-        
-        filtered_non_priority = non_priority_alerts[(non_priority_alerts['Deviation'] >= min_dev)].head(top_n)
-        final_alerts = pd.concat([priority_alerts, filtered_non_priority], ignore_index=True)
-        final_alerts = final_alerts.sort_values('Deviation', ascending=False)
-
-        st.write(f"Total alerts for {selected_province}: {len(final_alerts)} ({len(priority_alerts)} priority + {len(filtered_non_priority)} filtered)")
-
-        if not final_alerts.empty:
-            st.dataframe(final_alerts)
-
-            # Download as CSV to avoid openpyxl dependency
-            status.text('Preparing download...')
-            progress_bar.progress(100)
-            province_key = selected_province.lower().replace(" ", "_")
-            csv = final_alerts.to_csv(index=False).encode('utf-8')
-            st.download_button(
-                label=f"Download Alerts for {selected_province} Week {new_week} (CSV)",
-                data=csv,
-                file_name=f'alerts_{province_key}_week_{new_week}.csv',
-                mime='text/csv'
-            )
-        else:
-            st.warning("No alerts generated.")
-
+        st.session_state['alerts'] = {
+            'province': selected_province,
+            # file_id changes with every upload, even when a new export reuses the same file name
+            'file_id': new_file.file_id,
+            'alerts': alerts,
+            'new_week': new_week
+        }
     else:
         st.warning("Upload weekly data to generate alerts.")
 
     progress_bar.empty()
     status.empty()
 
+# Results stay on screen across reruns until the province or upload changes
+results = st.session_state.get('alerts')
+if results is not None and results['province'] == selected_province and new_file is not None and results['file_id'] == new_file.file_id:
+    # Priority filtering: one membership scan shared by both halves
+    alerts = results['alerts']
+    is_priority = alerts['Disease'].isin(frozenset(selected_priority_diseases)).to_numpy()
+    priority_alerts = alerts[is_priority]
+    non_priority_alerts = alerts[~is_priority]
+    st.write(f"Priority alerts count: {len(priority_alerts)}, Non-priority alerts count: {len(non_priority_alerts)}")  # Debug line - remove if not needed
+    max_dev = float(non_priority_alerts['Deviation'].max()) if len(non_priority_alerts) > 0 else 0.0
+    render_alerts(priority_alerts, non_priority_alerts, max_dev, selected_province, results['new_week'], offer_excel)
+
 # Instructions
 st.sidebar.title("Instructions")
 st.sidebar.write("1. Select province.")
 st.sidebar.write("2. Ensure the corresponding threshold file is in the same folder as app.py (e.g., AJK.csv for AJK, ICT.csv for Islamabad, Sindh.xlsx for Sindh).")
-st.sidebar.write("3. Upload weekly data (CSV/Excel).")
+st.sidebar.write("3. Upload weekly data (CSV/Excel/Parquet/Feather). Large Excel files are slow to parse, so export to CSV or Parquet when possible.")
 st.sidebar.write("4. Adjust filters and click 'Generate Alerts'.")
-st.sidebar.write("5. View and download results (CSV).")
+st.sidebar.write("5. View and download results (CSV, plus Excel if selected).")
 st.sidebar.write("Developer: Asad khan")
 